@@ -0,0 +1,154 @@
+"""
+Admin command line tools for SafeFast virtual tours.
+
+Replaces the one-off queries in database_query.ipynb. Every command streams rows
+from SQLite cursors and writes them out as it goes, so memory use stays flat no
+matter how large data/gens.db grows. It goes through the same database handle as
+the app (db.py), so only one SQLite library ever opens the file in this process.
+
+`adjust` checks the whole file before applying anything, and records each line's
+file digest and line number in the ledger ref, so re-running a file (for example
+after a crash part way) skips the lines that were already applied. Debits that
+would take a balance below zero are rejected, as they are everywhere else.
+
+    python admin.py export gens --format csv --out gens.csv
+    python admin.py adjust balances.csv --reason "goodwill credit"
+    python admin.py report --days 30
+"""
+
+import argparse, csv, hashlib, json, sys, time
+from db import db, transaction, _adjust_balance
+
+# Tables that can be exported
+EXPORT_TABLES = ('gens', 'users', 'ledger', 'jobs')
+
+# Write every row of a table to `out` as JSON lines or CSV; db.query yields rows as the cursor reads them
+def export(table, fmt, out):
+    rows = db.query(f"SELECT * FROM {table} ORDER BY rowid")
+    n = 0
+    if fmt == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(row, default=str) + "\n")
+            n += 1
+    else:
+        cols = [c['name'] for c in db.q(f"PRAGMA table_info({table})")]
+        writer = csv.DictWriter(out, fieldnames=cols)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            n += 1
+    return n
+
+class DryRun(Exception): pass
+
+# Yield (line, email, delta) for every row of an adjustments CSV, exiting on the first malformed line
+def read_adjustments(f):
+    for line, row in enumerate(csv.DictReader(f), start=2):
+        try: yield line, row['email'].strip(), int(row['delta'])
+        except (AttributeError, KeyError, TypeError, ValueError): sys.exit(f"Line {line}: expected columns email,delta with an integer delta")
+
+# Apply one batch of adjustments in a single transaction, skipping lines a previous run already applied.
+# Returns (number applied, rejected (line, email) pairs).
+def apply_batch(batch, digest, reason, dry_run):
+    applied, rejected = 0, []
+    try:
+        with transaction() as conn:
+            for line, email, delta in batch:
+                ref = f"{digest}:{line}"
+                if conn.q("SELECT 1 FROM ledger WHERE email = ? AND reason = 'adjustment' AND ref LIKE ?", [email, f"{ref} %"]): continue
+                if _adjust_balance(conn, email, delta, 'adjustment', ref=f"{ref} {reason}") is None: rejected.append((line, email))
+                else: applied += 1
+            if dry_run: raise DryRun()
+    except DryRun: pass
+    return applied, rejected
+
+# Apply balance adjustments from a CSV file with `email` and `delta` columns, after checking every line
+def adjust(path, reason, batch_size, dry_run):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20): digest.update(chunk)
+    digest = digest.hexdigest()[:16]
+    with open(path, newline='') as f:
+        for _ in read_adjustments(f): pass
+    applied, rejected, batch = 0, [], []
+    with open(path, newline='') as f:
+        for adjustment in read_adjustments(f):
+            batch.append(adjustment)
+            if len(batch) == batch_size:
+                n, r = apply_batch(batch, digest, reason, dry_run)
+                applied, rejected, batch = applied + n, rejected + r, []
+    if batch:
+        n, r = apply_batch(batch, digest, reason, dry_run)
+        applied, rejected = applied + n, rejected + r
+    return applied, rejected
+
+# Print revenue, credit and generation summaries computed in SQL
+def report(days):
+    since = time.time() - days * 86400
+    one = lambda sql, params=(): list(db.q(sql, params)[0].values())
+
+    n_users, active, balance = one("SELECT COUNT(*), SUM(is_active), COALESCE(SUM(balance), 0) FROM users")
+    print(f"Users: {n_users} ({active or 0} active), {balance} credits outstanding")
+
+    revenue, bought = one("SELECT COALESCE(SUM(amount_cents), 0), COALESCE(SUM(delta), 0) FROM ledger WHERE reason = 'purchase'")
+    # Credits refunded for images that failed to generate were never really spent
+    debited, refunded = one("""SELECT COALESCE(-SUM(CASE WHEN reason = 'generation' THEN delta END), 0),
+                                      COALESCE(SUM(CASE WHEN reason = 'refund' THEN delta END), 0) FROM ledger""")
+    print(f"Revenue: ${revenue / 100:.2f} for {bought} credits, {debited - refunded} credits spent on generations "
+          f"({debited} debited, {refunded} refunded for failed images)")
+
+    print(f"Generations: {one('SELECT COUNT(*) FROM gens')[0]} images")
+    for status, n in db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status ORDER BY status"):
+        print(f"  jobs {status}: {n}")
+
+    print(f"\nLast {days} days:")
+    print(f"{'day':<12}{'revenue':>10}{'bought':>8}{'spent':>8}{'jobs':>6}")
+    daily = db.execute("""
+        SELECT day, SUM(revenue), SUM(bought), SUM(spent), SUM(jobs) FROM (
+            SELECT date(created_at, 'unixepoch') AS day,
+                   SUM(CASE WHEN reason = 'purchase' THEN amount_cents ELSE 0 END) AS revenue,
+                   SUM(CASE WHEN reason = 'purchase' THEN delta ELSE 0 END) AS bought,
+                   SUM(CASE WHEN reason IN ('generation', 'refund') THEN -delta ELSE 0 END) AS spent,
+                   0 AS jobs
+            FROM ledger WHERE created_at >= ? GROUP BY day
+            UNION ALL
+            SELECT date(created_at, 'unixepoch'), 0, 0, 0, COUNT(*)
+            FROM jobs WHERE created_at >= ? GROUP BY 1)
+        GROUP BY day ORDER BY day""", (since, since))
+    for day, revenue, bought, spent, n_jobs in daily:
+        print(f"{day:<12}{f'${revenue / 100:.2f}':>10}{bought:>8}{spent:>8}{n_jobs:>6}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SafeFast virtual tours admin tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('export', help="stream a table as JSON lines or CSV")
+    p.add_argument('table', choices=EXPORT_TABLES)
+    p.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    p.add_argument('--out', help="output file (default: stdout)")
+
+    p = sub.add_parser('adjust', help="apply balance adjustments from a CSV file of email,delta rows")
+    p.add_argument('file')
+    p.add_argument('--reason', default='admin adjustment', help="recorded in the ledger ref, after the file digest and line number")
+    p.add_argument('--batch-size', type=int, default=500)
+    p.add_argument('--dry-run', action='store_true', help="roll back every batch instead of committing")
+
+    p = sub.add_parser('report', help="print revenue and generation summaries")
+    p.add_argument('--days', type=int, default=30)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        out = open(args.out, 'w', newline='') if args.out else sys.stdout
+        try: n = export(args.table, args.format, out)
+        finally:
+            if args.out: out.close()
+        print(f"Exported {n} rows from {args.table}", file=sys.stderr)
+    elif args.command == 'adjust':
+        applied, rejected = adjust(args.file, args.reason, args.batch_size, args.dry_run)
+        print(f"{'Would apply' if args.dry_run else 'Applied'} {applied} adjustments")
+        for line, email in rejected: print(f"  line {line}: no such user, or not enough credit for the debit: {email}")
+    elif args.command == 'report':
+        report(args.days)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,170 @@
+"""
+Build the site stylesheet and scripts for SafeFast virtual tours.
+
+Downloads the pinned Tailwind, DaisyUI and FrankenUI builds once (cached in
+assets/vendor), keeps only the rules whose classes appear in our Python sources,
+minifies the result and writes it as one content-hashed file in static/css, with
+gzip and (if the brotli package is installed) brotli versions next to it. The
+pinned htmx preload extension is vendored the same way into static/js, so every
+asset in the page head comes from our own origin.
+main.py reads static/manifest.json to link the current files.
+
+Run with `python build_assets.py` before starting the app (railway.toml does
+this as the build command).
+"""
+
+import gzip, hashlib, json, re, urllib.request
+from pathlib import Path
+
+try: import brotli
+except ImportError: brotli = None
+
+# Pinned framework builds, concatenated in this order
+SOURCES = {
+    'tailwind.css': "https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css",
+    'daisyui.css': "https://cdn.jsdelivr.net/npm/daisyui@4.12.14/dist/full.css",
+    'franken.css': "https://unpkg.com/franken-wc@0.1.0/dist/css/zinc.min.css",
+}
+
+# Files scanned for class names
+SCAN = ['main.py']
+
+# Classes to keep even though they are not written literally in the sources (e.g. added by JS)
+SAFELIST = {'htmx-request', 'htmx-indicator', 'htmx-settling', 'htmx-swapping', 'htmx-added'}
+
+# Pinned scripts, served as they are
+SCRIPTS = {
+    'preload.js': "https://unpkg.com/htmx-ext-preload@2.1.0/preload.js",
+}
+
+VENDOR_DIR = Path('assets/vendor')
+OUT_DIR = Path('static/css')
+JS_DIR = Path('static/js')
+MANIFEST = Path('static/manifest.json')
+
+# Download a framework build unless it is already cached
+def fetch(name, url):
+    path = VENDOR_DIR / name
+    if not path.exists():
+        print(f"Downloading {url}")
+        VENDOR_DIR.mkdir(parents=True, exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as r: path.write_bytes(r.read())
+    return path.read_text(encoding='utf-8')
+
+# Every whitespace-separated token inside a string literal is a candidate class name
+def used_classes(paths):
+    classes = set(SAFELIST)
+    for p in paths:
+        for lit in re.findall(r'"([^"\n]*)"|\'([^\'\n]*)\'', Path(p).read_text(encoding='utf-8')):
+            classes.update((lit[0] or lit[1]).split())
+    return classes
+
+# Split `text` on `sep` where it is not nested inside parentheses or brackets
+def split_top(text, sep):
+    parts, depth, start, quote = [], 0, 0, None
+    for i, ch in enumerate(text):
+        if quote:
+            if ch == quote: quote = None
+        elif ch in '"\'': quote = ch
+        elif ch in '([': depth += 1
+        elif ch in ')]': depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+# Parse a stylesheet into (prelude, body) blocks; statements like @charset have body None
+def blocks(css):
+    out, i, n = [], 0, len(css)
+    while i < n:
+        j = i
+        while j < n and css[j] not in '{;': j += 1
+        prelude = css[i:j].strip()
+        if j >= n:
+            break
+        if css[j] == ';':
+            if prelude: out.append((prelude, None))
+            i = j + 1
+            continue
+        depth, k, quote = 1, j + 1, None
+        while k < n and depth:
+            if quote:
+                if css[k] == quote: quote = None
+            elif css[k] in '"\'': quote = css[k]
+            elif css[k] == '{': depth += 1
+            elif css[k] == '}': depth -= 1
+            k += 1
+        out.append((prelude, css[j + 1:k - 1]))
+        i = k
+    return out
+
+CLASS_RE = re.compile(r'\.((?:\\.|[A-Za-z0-9_-])+)')
+
+# Remove :not(...) arguments, whose classes need not be present for the rule to apply
+def strip_not(selector):
+    while (i := selector.find(':not(')) != -1:
+        depth, k = 1, i + 5
+        while k < len(selector) and depth:
+            depth += {'(': 1, ')': -1}.get(selector[k], 0)
+            k += 1
+        selector = selector[:i] + selector[k:]
+    return selector
+
+def selector_used(selector, classes):
+    return all(re.sub(r'\\(.)', r'\1', c) in classes for c in CLASS_RE.findall(strip_not(selector)))
+
+def minify_decls(body):
+    decls = []
+    for d in split_top(body, ';'):
+        prop, sep, value = d.partition(':')
+        if sep: decls.append(f"{prop.strip()}:{' '.join(value.split())}")
+    return ';'.join(decls)
+
+# Keep only the rules that can match our markup, returning minified CSS
+def purge(css, classes):
+    out = []
+    for prelude, body in blocks(css):
+        prelude = ' '.join(prelude.split())
+        if body is None:
+            if prelude.startswith('@charset'): continue
+            out.append(prelude + ';')
+        elif prelude.startswith(('@media', '@supports', '@layer')):
+            inner = purge(body, classes)
+            if inner: out.append(f"{prelude}{{{inner}}}")
+        elif prelude.startswith('@'):
+            # @font-face, @keyframes, @property etc. are kept as they are
+            out.append(f"{prelude}{{{' '.join(body.split())}}}")
+        else:
+            selectors = [s.strip() for s in split_top(prelude, ',') if selector_used(s, classes)]
+            if selectors: out.append(f"{','.join(selectors)}{{{minify_decls(body)}}}")
+    return ''.join(out)
+
+# Write `data` as <stem>.<hash>.<ext> in `folder` with precompressed copies, dropping earlier builds; returns the name
+def write_hashed(folder, stem, ext, data):
+    name = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+    folder.mkdir(parents=True, exist_ok=True)
+    for old in folder.glob(f"{stem}.*.{ext}*"):
+        if not old.name.startswith(name): old.unlink()
+    (folder / name).write_bytes(data)
+    (folder / f"{name}.gz").write_bytes(gzip.compress(data, 9, mtime=0))
+    if brotli: (folder / f"{name}.br").write_bytes(brotli.compress(data, quality=11))
+    return name
+
+def build():
+    if not brotli: print("brotli not installed, skipping .br output")
+    classes = used_classes(SCAN)
+    css = '\n'.join(fetch(name, url) for name, url in SOURCES.items())
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    purged = purge(css, classes).encode('utf-8')
+    manifest = {'app.css': write_hashed(OUT_DIR, 'app', 'css', purged)}
+    print(f"{len(css):,} bytes of framework CSS -> {len(purged):,} bytes in {OUT_DIR / manifest['app.css']}")
+
+    for name, url in SCRIPTS.items():
+        stem, ext = name.rsplit('.', 1)
+        manifest[name] = write_hashed(JS_DIR, stem, ext, fetch(name, url).encode('utf-8'))
+        print(f"Vendored {url} as {JS_DIR / manifest[name]}")
+
+    MANIFEST.write_text(json.dumps(manifest, indent=2))
+
+if __name__ == '__main__': build()
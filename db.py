@@ -0,0 +1,277 @@
+"""
+Shared database setup for SafeFast virtual tours.
+
+The web app, the generation worker and any maintenance scripts all import their
+tables from here so they agree on one schema in data/gens.db. It also holds the
+job queue the web app uses to hand generations to the worker processes.
+"""
+
+from contextlib import contextmanager
+from fasthtml.common import database
+import json, os, re, threading, time
+
+DB_PATH = 'data/gens.db'
+
+db = database(DB_PATH)
+# WAL lets the web process read while workers write; wait on locks instead of failing
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA busy_timeout=5000")
+tables = db.t
+
+# Set up database for storing generated image details
+gens = tables.gens
+if not gens in tables:
+    gens.create(prompt=str, session_id=str, id=int, folder=str, status=str, email=str, created_at=float, cold=bool,
+                tour_type=str, anonymous=bool, pk='id')
+# status is 'pending' until the worker saves the image ('done') or gives up on it and refunds it ('failed');
+# 'lost' marks rows from before the job queue whose image was never saved (see below);
+# email is the owner (NULL on rows from before it was recorded, which were all made by logged-in users);
+# anonymous marks generations made without an account, which retention.py can expire (generating currently
+# requires an account, so nothing sets it); cold images were re-encoded as WebP by retention.py
+for col, typ in (('status', str), ('email', str), ('created_at', float), ('cold', bool), ('tour_type', str),
+                 ('anonymous', bool)):
+    if col not in gens.columns_dict:
+        gens.add_column(col, typ)
+        # Existing rows have no timestamp; age them from the upgrade
+        if col == 'created_at': db.execute("UPDATE gens SET created_at = ?", [time.time()])
+db.execute("CREATE INDEX IF NOT EXISTS idx_gens_folder ON gens (folder)")
+db.execute("CREATE INDEX IF NOT EXISTS idx_gens_email ON gens (email, id)")
+db.execute("CREATE INDEX IF NOT EXISTS idx_gens_created_at ON gens (created_at)")
+
+# Rows from before status was tracked: done if their image was saved, else lost, since the thread that
+# generated them is long gone. Without this their cards would poll forever. They can't be refunded like
+# 'failed' rows: they have no email, so there is no record of whose credit paid for them.
+db.execute("CREATE INDEX IF NOT EXISTS idx_gens_status_null ON gens (id) WHERE status IS NULL")
+while legacy := db.q("SELECT id, folder FROM gens WHERE status IS NULL LIMIT 500"):
+    saved = {r['id'] for r in legacy if os.path.exists(f"{r['folder']}/{r['id']}.png")}
+    for status, ids in (('done', saved), ('lost', {r['id'] for r in legacy} - saved)):
+        if ids: db.execute(f"UPDATE gens SET status = ? WHERE id IN ({','.join('?' * len(ids))})", [status, *ids])
+# An earlier version of this backfill marked them failed; every real failed row has an email
+db.execute("UPDATE gens SET status = 'lost' WHERE email IS NULL AND status = 'failed'")
+Generation = gens.dataclass()
+
+# Full-text index over prompts and tour types, kept in sync with gens by triggers.
+# The owner column holds a single token per user (or per anonymous session), so a search only
+# walks that owner's postings. Its text is read back from the gens_fts_source view for snippets.
+GENS_OWNER_SQL = "'u' || hex(COALESCE({0}.email, {0}.session_id))"
+SQL_CREATE_GENS_FTS = [
+    f"""CREATE VIEW IF NOT EXISTS gens_fts_source AS
+        SELECT id, prompt, tour_type, {GENS_OWNER_SQL.format('gens')} AS owner FROM gens""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS gens_fts USING fts5(
+        prompt, tour_type, owner, content='gens_fts_source', content_rowid='id', tokenize='porter unicode61')""",
+    f"""CREATE TRIGGER IF NOT EXISTS gens_fts_insert AFTER INSERT ON gens BEGIN
+        INSERT INTO gens_fts (rowid, prompt, tour_type, owner)
+        VALUES (new.id, new.prompt, new.tour_type, {GENS_OWNER_SQL.format('new')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS gens_fts_delete AFTER DELETE ON gens BEGIN
+        INSERT INTO gens_fts (gens_fts, rowid, prompt, tour_type, owner)
+        VALUES ('delete', old.id, old.prompt, old.tour_type, {GENS_OWNER_SQL.format('old')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS gens_fts_update AFTER UPDATE OF prompt, tour_type, email, session_id ON gens BEGIN
+        INSERT INTO gens_fts (gens_fts, rowid, prompt, tour_type, owner)
+        VALUES ('delete', old.id, old.prompt, old.tour_type, {GENS_OWNER_SQL.format('old')});
+        INSERT INTO gens_fts (rowid, prompt, tour_type, owner)
+        VALUES (new.id, new.prompt, new.tour_type, {GENS_OWNER_SQL.format('new')});
+    END""",
+]
+
+if not db.q("SELECT name FROM sqlite_master WHERE name = 'gens_fts'"):
+    for sql in SQL_CREATE_GENS_FTS: db.execute(sql)
+    # Index the rows that existed before the index did
+    db.execute("INSERT INTO gens_fts (gens_fts) VALUES ('rebuild')")
+
+# Set up database for storing user details
+SQL_CREATE_USERS = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY NOT NULL,
+    magic_link_token TEXT,
+    magic_link_expiry TIMESTAMP,
+    is_active BOOLEAN DEFAULT FALSE,
+    balance INTEGER DEFAULT 0  -- Balance field for user credits
+);
+"""
+
+if not 'users' in tables:
+    db.execute(SQL_CREATE_USERS)
+
+users = tables.users
+User = users.dataclass()
+
+# Set up the generation job queue, one job per prediction (a batch of gens rows)
+jobs = tables.jobs
+if not jobs in tables:
+    jobs.create(id=int, prompt=str, folder=str, gen_ids=str, email=str, status=str, attempts=int,
+                lease_owner=str, lease_expires=float, created_at=float, pk='id')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_lease ON jobs (status, lease_expires)")
+Job = jobs.dataclass()
+
+# Set up the credit ledger, one row per balance change (purchases, generations, adjustments)
+ledger = tables.ledger
+if not ledger in tables:
+    ledger.create(id=int, email=str, delta=int, amount_cents=int, reason=str, ref=str, created_at=float, pk='id')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_email ON ledger (email)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_created_at ON ledger (created_at)")
+
+# Last run of each periodic maintenance task, so only one worker runs it per interval
+if not 'maintenance' in tables:
+    db.execute("CREATE TABLE IF NOT EXISTS maintenance (name TEXT PRIMARY KEY NOT NULL, last_run REAL NOT NULL DEFAULT 0)")
+
+# Responses to idempotent form submissions, replayed when the same key is submitted again
+if not 'idempotency' in tables:
+    db.execute("""CREATE TABLE IF NOT EXISTS idempotency (
+        key TEXT PRIMARY KEY NOT NULL,
+        status TEXT NOT NULL,  -- 'pending' while the first request runs, then 'done'
+        response TEXT,
+        created_at REAL NOT NULL)""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created_at ON idempotency (created_at)")
+
+# Transactions run on a connection of their own per thread. `db` is shared by every request thread,
+# so a transaction opened on it would fail to nest with another thread's and take in its writes.
+# The connections are opened with the same library as `db`: two SQLite copies opening one file in one
+# process can corrupt it, since closing a file in one drops the locks the other holds on it.
+_local = threading.local()
+
+def _connection():
+    if not hasattr(_local, 'db'):
+        _local.db = database(DB_PATH)
+        _local.db.execute("PRAGMA busy_timeout=5000")
+    return _local.db
+
+# Run the enclosed statements in one write transaction, taking the write lock up front.
+# Yields the connection; run every statement that belongs to the transaction on it.
+@contextmanager
+def transaction():
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try: yield conn
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+# Balance change for use inside an open transaction. Debits only apply if the balance covers them;
+# returns the new balance, or None if there is no such user or not enough credit.
+def _adjust_balance(conn, email, delta, reason, ref=None, amount_cents=0):
+    rows = conn.q("UPDATE users SET balance = balance + ? WHERE email = ? AND (? >= 0 OR balance >= -?) RETURNING balance",
+                  [delta, email, delta, delta])
+    if not rows: return None
+    conn.q("INSERT INTO ledger (email, delta, amount_cents, reason, ref, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+           [email, delta, amount_cents, reason, ref, time.time()])
+    return rows[0]['balance']
+
+# Change a user's balance and record it in the ledger; returns the new balance, or None if there is
+# no such user or a debit is larger than the balance
+def adjust_balance(email, delta, reason, ref=None, amount_cents=0):
+    with transaction() as conn:
+        return _adjust_balance(conn, email, delta, reason, ref, amount_cents)
+
+# Claim a periodic task if it has not run in the last `interval` seconds
+def claim_maintenance(name, interval):
+    now = time.time()
+    db.execute("INSERT OR IGNORE INTO maintenance (name, last_run) VALUES (?, 0)", [name])
+    return bool(db.q("UPDATE maintenance SET last_run = ? WHERE name = ? AND last_run < ? RETURNING name",
+                     [now, name, now - interval]))
+
+# The owner token of an email or session id, matching GENS_OWNER_SQL
+def owner_token(value): return 'u' + value.encode().hex().upper()
+
+# Full-text search over the generations of the given owners (emails or session ids), best matches first.
+# Each result has a `snippet` of its prompt with matches wrapped in \x02 and \x03.
+def search_gens(text, owners, limit, offset=0):
+    terms = re.findall(r'\w+', text)
+    owners = [o for o in owners if o]
+    if not terms or not owners: return []
+    # Quote every term so user input can't use FTS syntax; the last one also matches as a prefix
+    match = ' '.join(f'"{t}"' for t in terms) + '*'
+    match = f"({' OR '.join(f'owner:{owner_token(o)}' for o in owners)}) AND {{prompt tour_type}}: ({match})"
+    return db.q("""
+        SELECT g.*, snippet(gens_fts, 0, char(2), char(3), '…', 16) AS snippet
+        FROM gens_fts JOIN gens g ON g.id = gens_fts.rowid
+        WHERE gens_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?""", [match, limit, offset])
+
+# Try to become the request that executes `key`, taking over a claim left pending for more than `stale_after`
+# seconds (its request died with its process); False if another request has it. Old rows are pruned by retention.py.
+def claim_idempotency_key(key, stale_after):
+    now = time.time()
+    return bool(db.q("""INSERT INTO idempotency (key, status, created_at) VALUES (?, 'pending', ?)
+                        ON CONFLICT (key) DO UPDATE SET created_at = excluded.created_at
+                        WHERE status = 'pending' AND created_at < ? RETURNING key""", [key, now, now - stale_after]))
+
+# Store the response of the request that claimed `key`
+def store_idempotent_response(key, response):
+    db.execute("UPDATE idempotency SET status = 'done', response = ? WHERE key = ?", [response, key])
+
+# The idempotency row for `key` (its status, stored response and claim time), or None if it isn't claimed
+def idempotency_entry(key):
+    rows = db.q("SELECT status, response, created_at FROM idempotency WHERE key = ?", [key])
+    return rows[0] if rows else None
+
+# Forget a key whose request failed, so that it can be retried
+def release_idempotency_key(key):
+    db.execute("DELETE FROM idempotency WHERE key = ?", [key])
+
+# Debit one credit per image, insert a pending gens row for each and queue their job, in one transaction,
+# so a failure part way leaves neither a debit without images nor rows that no job will ever settle.
+# Returns (new balance, gens rows), or None if the balance does not cover the images.
+def create_generations(email, session_id, prompt, folder, tour_type, count):
+    now = time.time()
+    with transaction() as conn:
+        balance = _adjust_balance(conn, email, -count, 'generation')
+        if balance is None: return None
+        rows = [conn.q("""INSERT INTO gens (prompt, folder, session_id, status, email, created_at, tour_type)
+                          VALUES (?, ?, ?, 'pending', ?, ?, ?) RETURNING *""",
+                       [prompt, folder, session_id, email, now, tour_type])[0] for _ in range(count)]
+        conn.q("INSERT INTO jobs (prompt, folder, gen_ids, email, status, attempts, created_at) VALUES (?, ?, ?, ?, 'queued', 0, ?)",
+               [prompt, folder, json.dumps([r['id'] for r in rows]), email, now])
+    return balance, rows
+
+# Claim the oldest queued job, or one whose worker let its lease expire
+def claim_job(owner, lease_seconds, max_attempts):
+    now = time.time()
+    with transaction() as conn:
+        rows = conn.q("""
+            UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (status = 'queued' OR (status = 'running' AND lease_expires < ?)) AND attempts < ?
+                ORDER BY id LIMIT 1)
+            RETURNING *""", [owner, now + lease_seconds, now, max_attempts])
+    return Job(**rows[0]) if rows else None
+
+# Extend a lease; returns False if the job is no longer ours (e.g. it was reclaimed)
+def heartbeat_job(id, owner, lease_seconds):
+    rows = db.q("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = 'running' RETURNING id",
+                [time.time() + lease_seconds, id, owner])
+    return bool(rows)
+
+# Put a job we hold back on the queue without counting the attempt (e.g. Replicate is unavailable)
+def release_job(id, owner):
+    db.q("""UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires = NULL, attempts = attempts - 1
+            WHERE id = ? AND lease_owner = ? AND status = 'running' RETURNING id""", [id, owner])
+
+# Mark the gens rows of a finished job and refund one credit for every image that was not generated
+def _settle_job(conn, job, done_ids, failed_ids):
+    status = 'failed' if not done_ids else 'done'
+    conn.q("UPDATE jobs SET status = ?, lease_expires = NULL WHERE id = ?", [status, job['id']])
+    for ids, gen_status in ((done_ids, 'done'), (failed_ids, 'failed')):
+        if ids: conn.q(f"UPDATE gens SET status = ? WHERE id IN ({','.join('?' * len(ids))})", [gen_status, *ids])
+    if failed_ids: _adjust_balance(conn, job['email'], len(failed_ids), 'refund', ref=f"job-{job['id']}")
+
+# Record the final state of a job we hold the lease on; returns False if the lease was lost
+def finish_job(id, owner, done_ids, failed_ids):
+    with transaction() as conn:
+        rows = conn.q("SELECT * FROM jobs WHERE id = ? AND lease_owner = ? AND status = 'running'", [id, owner])
+        if not rows: return False
+        _settle_job(conn, rows[0], done_ids, failed_ids)
+    return True
+
+# Give up on jobs whose workers kept dying: keep the images that were saved and refund the rest
+def fail_abandoned_jobs(max_attempts):
+    with transaction() as conn:
+        rows = conn.q("SELECT * FROM jobs WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                      [time.time(), max_attempts])
+        for job in rows:
+            ids = json.loads(job['gen_ids'])
+            done = [id for id in ids if os.path.exists(f"{job['folder']}/{id}.png")]
+            _settle_job(conn, job, done, [id for id in ids if id not in done])
+    return len(rows)
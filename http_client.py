@@ -0,0 +1,121 @@
+"""
+Shared outbound HTTP client for SafeFast virtual tours.
+
+Every call we make to another service (Replicate, the image CDN, Stripe and Resend)
+goes through the one `transport` below. It keeps a keep-alive connection pool per
+host, negotiates HTTP/2 where the host supports it (when the h2 package is
+installed), applies explicit connect/read timeouts, caps the number of concurrent
+requests per host (waiting at most the pool timeout for a free slot) and records
+per-host metrics.
+
+Use `http` for our own requests, or pass `transport` to SDKs built on httpx.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass, field, asdict
+import os, threading, time, httpx
+
+try:
+    import h2
+    HTTP2 = True
+except ImportError: HTTP2 = False
+
+# Default timeouts, in seconds; callers can pass a tighter timeout per request
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+TIMEOUT = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+# Connections kept per host, and how many requests may be in flight to one host at once
+MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 10))
+KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 60))
+HOST_CONCURRENCY = {'api.replicate.com': 8, 'replicate.delivery': 8, 'api.stripe.com': 4, 'api.resend.com': 2}
+DEFAULT_CONCURRENCY = int(os.getenv('HTTP_HOST_CONCURRENCY', 8))
+# Longest wait for a free slot when the request doesn't set a pool timeout
+POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', 30))
+
+@dataclass
+class HostMetrics:
+    requests: int = 0
+    errors: int = 0
+    in_flight: int = 0
+    total_seconds: float = 0
+    max_seconds: float = 0
+    statuses: dict = field(default_factory=lambda: defaultdict(int))
+
+class _ReleasingStream(httpx.SyncByteStream):
+    "Response body that calls `on_close` once the caller has finished reading it"
+    def __init__(self, stream, on_close): self.stream, self.on_close = stream, on_close
+    def __iter__(self): yield from self.stream
+    def close(self):
+        try: self.stream.close()
+        finally:
+            if self.on_close: self.on_close()
+            self.on_close = None
+
+class PooledTransport(httpx.BaseTransport):
+    "Sends each request through a keep-alive pool for its host, limiting concurrency and recording metrics"
+    def __init__(self):
+        self.pools, self.slots = {}, {}
+        self.metrics = defaultdict(HostMetrics)
+        self.lock = threading.Lock()
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.pools:
+                limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS,
+                                      keepalive_expiry=KEEPALIVE_EXPIRY)
+                self.pools[host] = httpx.HTTPTransport(http2=HTTP2, limits=limits)
+                self.slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, DEFAULT_CONCURRENCY))
+            return self.pools[host], self.slots[host]
+
+    def _record(self, host, start, status=None):
+        elapsed = time.monotonic() - start
+        with self.lock:
+            m = self.metrics[host]
+            m.in_flight -= 1
+            m.requests += 1
+            m.total_seconds += elapsed
+            m.max_seconds = max(m.max_seconds, elapsed)
+            if status is None: m.errors += 1
+            else: m.statuses[status] += 1
+
+    def handle_request(self, request):
+        host = request.url.host
+        pool, slot = self._host(host)
+        # The concurrency slot is held until the response body has been read or closed. Wait for one no longer
+        # than the pool timeout, so a response that is never closed can't block every later request to the host.
+        timeout = request.extensions.get('timeout', {}).get('pool')
+        if not slot.acquire(timeout=POOL_TIMEOUT if timeout is None else timeout):
+            with self.lock: self.metrics[host].errors += 1
+            raise httpx.PoolTimeout(f"No free request slot for {host}", request=request)
+        start = time.monotonic()
+        with self.lock: self.metrics[host].in_flight += 1
+        try: response = pool.handle_request(request)
+        except:
+            self._record(host, start)
+            slot.release()
+            raise
+        def done():
+            self._record(host, start, response.status_code)
+            slot.release()
+        return httpx.Response(status_code=response.status_code, headers=response.headers,
+                              stream=_ReleasingStream(response.stream, done), extensions=response.extensions)
+
+    def close(self):
+        for pool in self.pools.values(): pool.close()
+
+    # Per-host metrics as plain dicts, with the mean latency filled in
+    def snapshot(self):
+        with self.lock:
+            return {host: {**asdict(m), 'statuses': dict(m.statuses),
+                           'mean_seconds': m.total_seconds / m.requests if m.requests else 0}
+                    for host, m in self.metrics.items()}
+
+transport = PooledTransport()
+http = httpx.Client(transport=transport, timeout=TIMEOUT, follow_redirects=True)
+
+# One line per host, for logs
+def format_metrics():
+    return '\n'.join(f"{host}: {m['requests']} requests, {m['errors']} errors, {m['in_flight']} in flight, "
+                     f"mean {m['mean_seconds']:.3f}s, max {m['max_seconds']:.3f}s, statuses {m['statuses']}"
+                     for host, m in transport.snapshot().items())
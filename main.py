@@ -10,17 +10,20 @@ an immersive and educational experience.
 """
 
 # Import necessary libraries and modules
-from fastcore.parallel import threaded
 from fasthtml.common import *
-import uuid, os, uvicorn, requests, replicate, stripe
-from PIL import Image
+import uuid, os, json, time, html, uvicorn, stripe
 from starlette.responses import RedirectResponse
 import os
 from dotenv import load_dotenv 
 import random
 import secrets
 from datetime import datetime, timedelta
-import resend
+from urllib.parse import quote
+import httpx
+from db import gens, Generation, users, User, adjust_balance, create_generations, search_gens
+from db import claim_idempotency_key, store_idempotent_response, idempotency_entry, release_idempotency_key
+from http_client import http, transport
+from profiling import ProfilingMiddleware
 
 # Flag to switch between development and production modes
 dev_mode = False
@@ -38,57 +41,82 @@ else:
 if os.getenv("NAME") == "A88402735" or os.getenv("NAME") == "DESKTOP-23CHMFJ":  
     load_dotenv(".env_test")
 
-# Set up Replicate client for image generation
-replicate_api_token = os.environ['REPLICATE_API_KEY']
-client = replicate.Client(api_token=replicate_api_token)
+# Stripe's SDK talks to its API through the shared connection pools (see http_client.py)
+class PooledStripeClient(stripe.HTTPClient):
+    name = "httpx-pooled"
+
+    def _send(self, method, url, headers, post_data, stream):
+        try:
+            request = http.build_request(method, url, headers=headers, content=post_data, timeout=httpx.Timeout(80, connect=5))
+            return http.send(request, stream=stream)
+        except httpx.TransportError as e:
+            # Let the SDK's own retry logic handle connection errors
+            raise stripe.error.APIConnectionError(f"Network error communicating with Stripe: {e!r}", should_retry=True)
+
+    def request(self, method, url, headers, post_data=None):
+        r = self._send(method, url, headers, post_data, stream=False)
+        return r.content, r.status_code, r.headers
+
+    def request_stream(self, method, url, headers, post_data=None):
+        r = self._send(method, url, headers, post_data, stream=True)
+        return StripeStreamBody(r), r.status_code, r.headers
+
+    def close(self): pass
+
+# Body of a streamed Stripe response, read with read() (as Stripe does for errors) or by iterating it.
+# The response is closed once the body has been consumed, so its connection slot is freed.
+class StripeStreamBody:
+    def __init__(self, response): self.response = response
+
+    def read(self):
+        try: return self.response.read()
+        finally: self.response.close()
+
+    def __iter__(self):
+        try: yield from self.response.iter_bytes()
+        finally: self.response.close()
+
+    def close(self): self.response.close()
 
 # Set up Stripe for payment processing
 stripe.api_key = os.environ["STRIPE_KEY"]
+stripe.default_http_client = PooledStripeClient()
 webhook_secret = os.environ['STRIPE_WEBHOOK_SECRET']
 DOMAIN = os.environ['DOMAIN']
 
-# Set up Resend for email sending
+# Set up Resend for email sending (called directly over the shared HTTP client)
 resend_api_key = os.environ.get('RESEND_API_KEY')
 
-if resend_api_key:
-    resend.api_key = resend_api_key
-else:
+if not resend_api_key:
     print("Warning: RESEND_API_KEY not set. Email functionality may not work.")
 
+# Emails of users allowed to see admin-only routes, comma separated
+ADMIN_EMAILS = {e.strip() for e in os.getenv('ADMIN_EMAILS', '').split(',') if e.strip()}
+
 # Remove trailing slash from DOMAIN if present
 if DOMAIN.endswith('/'):
     DOMAIN = DOMAIN[:-1]
 
-# Set up database for storing generated image details
-tables = database('data/gens.db').t
-gens = tables.gens
-if not gens in tables:
-    gens.create(prompt=str, session_id=str, id=int, folder=str, pk='id')
-Generation = gens.dataclass()
-
-# Set up database for storing user details
-SQL_CREATE_USERS = """
-CREATE TABLE IF NOT EXISTS users (
-    email TEXT PRIMARY KEY NOT NULL,
-    magic_link_token TEXT,
-    magic_link_expiry TIMESTAMP,
-    is_active BOOLEAN DEFAULT FALSE,
-    balance INTEGER DEFAULT 0  -- Balance field for user credits
-);
-"""
-
-if not 'users' in tables:
-    db = database('data/gens.db')
-    db.execute(SQL_CREATE_USERS)   
-
-users = tables.users
-User = users.dataclass()
-
 # Define CDN links for Tailwind CSS, DaisyUI, and FrankenUI
 tailwind_cdn = Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css")
-daisyui_cdn = Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/daisyui@latest/dist/full.css")
+daisyui_cdn = Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/daisyui@4.12.14/dist/full.css")
 frankenui = Link(rel='stylesheet', href='https://unpkg.com/franken-wc@0.1.0/dist/css/zinc.min.css')
 
+# Use the purged, self-hosted bundles from build_assets.py when they have been built, else the CDN builds
+CSS_DIR, JS_DIR = 'static/css', 'static/js'
+if os.path.exists("static/manifest.json"):
+    with open("static/manifest.json") as f: bundles = json.load(f)
+    css_hdrs = (Link(rel="stylesheet", href=f"/{CSS_DIR}/{bundles['app.css']}"),)
+    preload_src = f"/{JS_DIR}/{bundles['preload.js']}"
+else:
+    print("Warning: static/manifest.json not found, run build_assets.py. Falling back to CDN stylesheets and scripts.")
+    css_hdrs = (tailwind_cdn, daisyui_cdn, frankenui)
+    preload_src = "https://unpkg.com/htmx-ext-preload@2.1.0/preload.js"
+
+# htmx preload extension, used by the boosted navigation bar to fetch pages on hover.
+# Deferred so it doesn't block rendering; it still registers before htmx processes the page on DOMContentLoaded.
+preload_ext = Script(src=preload_src, defer=True)
+
 # Define login redirect response
 login_redir = RedirectResponse('/', status_code=303)
 
@@ -101,9 +129,35 @@ bware = Beforeware(before, skip=[r'/favicon\.ico', r'/static/.*', r'.*\.css', '/
 
 # Initialize FastHTML app with Tailwind, DaisyUI, and authentication middleware
 if dev_mode == True:
-    app = FastHTMLWithLiveReload(hdrs=(tailwind_cdn, daisyui_cdn, frankenui))
+    app = FastHTMLWithLiveReload(hdrs=(*css_hdrs, preload_ext))
 else:
-    app = FastHTMLWithLiveReload(hdrs=(tailwind_cdn, daisyui_cdn, frankenui),before=bware)
+    app = FastHTMLWithLiveReload(hdrs=(*css_hdrs, preload_ext),before=bware)
+
+# Profile signed or sampled requests on demand (see profiling.py)
+app.add_middleware(ProfilingMiddleware)
+
+# Boosted navigation responses can be reused from the browser's cache for a few seconds, so the click after a
+# preload (on hover) doesn't render the page a second time. Vary keeps them apart from full page loads.
+BOOST_CACHE_SECONDS = int(os.getenv('BOOST_CACHE_SECONDS', 10))
+
+class BoostCacheMiddleware:
+    "Marks successful boosted GET responses privately cacheable for BOOST_CACHE_SECONDS"
+    def __init__(self, app): self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] != 'http' or scope['method'] != 'GET' or not BOOST_CACHE_SECONDS
+            or (b'hx-boosted', b'true') not in scope['headers']):
+            return await self.app(scope, receive, send)
+        async def send_cacheable(message):
+            if message['type'] == 'http.response.start' and message['status'] == 200:
+                headers = [(k, v) for k, v in message.get('headers', []) if k.lower() not in (b'cache-control', b'vary')]
+                headers += [(b'cache-control', f"private, max-age={BOOST_CACHE_SECONDS}".encode()),
+                            (b'vary', b'HX-Request, HX-Boosted')]
+                message = {**message, 'headers': headers}
+            await send(message)
+        await self.app(scope, receive, send_cacheable)
+
+app.add_middleware(BoostCacheMiddleware)
 
 # Add inline CSS for hover zoom effect
 hover_style = Style("""
@@ -120,12 +174,74 @@ def is_user_logged_in(session):
     is_logged_in = 'auth' in session and session['auth'] is not None
     return is_logged_in
 
+# Check if the logged in user is an admin
+def is_admin(session):
+    return is_user_logged_in(session) and session['auth'] in ADMIN_EMAILS
+
+# How long a duplicate waits for the first submission to finish, and after how long a submission still in
+# progress is taken to have died with its process. Stored responses are pruned by retention.py.
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 30))
+IDEMPOTENCY_STALE = float(os.getenv('IDEMPOTENCY_STALE', 120))
+
+# Hidden form field with a fresh idempotency key; responses send a new one with oob=True so the next submission is distinct
+def idem_key_input(id, oob=False):
+    return Input(type="hidden", name="idem_key", id=id, value=uuid.uuid4().hex, hx_swap_oob="true" if oob else None)
+
+# Render a handler's response (a component or tuple of components) to HTML
+def render(response):
+    return ''.join(to_xml(o) for o in (response if isinstance(response, tuple) else (response,)) if o is not None)
+
+# Raised by an idempotent handler to answer without storing the answer, for errors that a retry of the
+# same submission may get past (a failed Stripe call, a missing user)
+class RetryableResponse(Exception):
+    def __init__(self, response): self.response = response
+
+# Run fn once per idempotency key. Repeats of the key get the first response replayed, waiting for it
+# if the first request is still running; if that request fails the key is released and a repeat runs fn itself.
+def idempotent(key, fn):
+    if not key:
+        try: return fn()
+        except RetryableResponse as e: return e.response
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    claimed = claim_idempotency_key(key, IDEMPOTENCY_STALE)
+    # A duplicate only reads until the first submission is done; it writes again only to take over the key
+    # if that submission released it or died
+    while not claimed:
+        entry = idempotency_entry(key)
+        if entry and entry['status'] == 'done':
+            print(f"Replaying response for idempotency key {key}")
+            return NotStr(entry['response'])
+        if entry is None or entry['created_at'] < time.time() - IDEMPOTENCY_STALE:
+            claimed = claim_idempotency_key(key, IDEMPOTENCY_STALE)
+            continue
+        if time.monotonic() > deadline:
+            return Div("Your previous request is still being processed, please wait.", cls="text-red-500")
+        time.sleep(0.1)
+    try: response = render(fn())
+    except RetryableResponse as e:
+        release_idempotency_key(key)
+        return e.response
+    except:
+        release_idempotency_key(key)
+        raise
+    store_idempotent_response(key, response)
+    return NotStr(response)
+
+# Balance shown in the navigation bar; responses that change it send it back with oob=True
+def balance_span(balance, oob=False):
+    return Span(f'Balance: {balance} credits',
+                cls='ml-4 text-sm',
+                id="credit-balance",
+                hx_swap_oob="true" if oob else None)
+
 # Define the common navigation bar for the app
+# Links are boosted: htmx fetches the page (preloaded on hover) and swaps only <main> and the balance,
+# keeping the already loaded stylesheets and scripts
 def navigation_bar(session):
     is_logged_in = is_user_logged_in(session)
     common_links = [
-        Li(A('Home', href='/', cls='btn btn-ghost btn-sm rounded-btn')),
-        Li(A('About', href='/about', cls='btn btn-ghost btn-sm rounded-btn')),
+        Li(A('Home', href='/', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
+        Li(A('About', href='/about', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
     ]
 
     if is_logged_in:
@@ -133,23 +249,21 @@ def navigation_bar(session):
         try:
             user = users[user_email]
             user_links = [
-                Li(A('Generate Images', href='/generate_images', cls='btn btn-ghost btn-sm rounded-btn')),
-                Li(A('Buy Credits', href='/buy_credits', cls='btn btn-ghost btn-sm rounded-btn')),
-                Li(A('Logout', href='/logout', cls='btn btn-ghost btn-sm rounded-btn')),
+                Li(A('Generate Images', href='/generate_images', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
+                Li(A('Search', href='/search', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
+                Li(A('Buy Credits', href='/buy_credits', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
+                # Logging out is a full page load and must never be preloaded
+                Li(A('Logout', href='/logout', cls='btn btn-ghost btn-sm rounded-btn', hx_boost="false")),
             ]
-            balance_display = Span(f'Balance: {user.balance} credits', 
-                                   cls='ml-4 text-sm', 
-                                   id="credit-balance",
-                                   hx_get="/get_updated_balance",
-                                   hx_trigger="balanceUpdated from:body")
+            balance_display = balance_span(user.balance)
         except NotFoundError:
             user_links = [
-                Li(A('Login', href='/login', cls='btn btn-ghost btn-sm rounded-btn')),
+                Li(A('Login', href='/login', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
             ]
             balance_display = None
     else:
         user_links = [
-            Li(A('Login', href='/login', cls='btn btn-ghost btn-sm rounded-btn')),
+            Li(A('Login', href='/login', cls='btn btn-ghost btn-sm rounded-btn', preload="mouseover")),
         ]
         balance_display = None
 
@@ -166,6 +280,12 @@ def navigation_bar(session):
             ),
             cls='flex-none'
         ),
+        hx_boost="true",
+        hx_ext="preload",
+        hx_target="main",
+        hx_select="main",
+        hx_swap="outerHTML",
+        hx_select_oob="#credit-balance",
         cls='navbar bg-blue-500 text-white flex justify-between items-center'
     )
 
@@ -190,7 +310,7 @@ def MyLoginForm(btn_text: str, target: str, cls: str = ""):
 
 # Helper function to send magic link email
 def send_magic_link_email(email: str, magic_link: str):
-    r = resend.Emails.send({
+    r = http.post("https://api.resend.com/emails", headers={"Authorization": f"Bearer {resend_api_key}"}, json={
         "from": "noreply@alexkelly.world",
         "to": f"{email}",
         "subject": "Sign in to The App",
@@ -201,15 +321,26 @@ def send_magic_link_email(email: str, magic_link: str):
         If you didn't request this, just ignore this email.
         </p>"""
     })
+    r.raise_for_status()
 
 
+# Maximum number of images the model returns from a single prediction
+MAX_OUTPUTS = 4
+
+# Tour types offered on the generation form
+TOUR_TYPES = ('emperors', 'gladiators', 'citizens')
+
+# Path of a generation's image; cold images were re-encoded as WebP by retention.py
+def gen_image_path(folder, id, cold):
+    return f"{folder}/{id}.{'webp' if cold else 'png'}"
+
 # Show the image (if available) and prompt for a generation
 def generation_preview(g, session):
     # Ensure the session ID matches
     if g.session_id != session['session_id']: return "Wrong session ID!"
     
     # Construct the image path
-    image_path = f"{g.folder}/{g.id}.png"
+    image_path = gen_image_path(g.folder, g.id, g.cold)
     
     # If the image exists, return a preview card
     if os.path.exists(image_path):
@@ -231,6 +362,23 @@ def generation_preview(g, session):
             cls="w-full p-4"
         )
     
+    # If the worker gave up on the image, stop polling; the credit has already been refunded
+    if g.status == 'failed':
+        return Div(
+            P(f"Generating with prompt '{g.prompt}' failed.", cls="text-sm"),
+            P("Your credit has been refunded.", cls="text-sm"),
+            id=f'gen-{g.id}',
+            cls="w-full p-4"
+        )
+
+    # Images from before the job queue that were never saved; there is no record of the debit to refund
+    if g.status == 'lost':
+        return Div(
+            P(f"The image for prompt '{g.prompt}' was never saved.", cls="text-sm"),
+            id=f'gen-{g.id}',
+            cls="w-full p-4"
+        )
+
     # If the image is still generating, return a placeholder
     return Div(
         f"Generating with prompt '{g.prompt}'...",
@@ -241,33 +389,6 @@ def generation_preview(g, session):
         cls="w-full p-4"
     )
 
-# Generate an image and save it to the folder (in a separate thread)
-@threaded
-def generate_and_save(prompt, id, folder):
-    # Call the Replicate API to generate the image
-    output = client.run(
-        "resolver101757/akflux:a8a38acebd2b927ea95ab68a2e20626c81b135196116dbff8db298baf1da1fd0",
-        input={
-            "width": 1024,
-            "height": 1024,
-            "model": "dev",
-            "prompt": prompt,
-            "lora_scale": 1.34,
-            "num_outputs": 1,
-            "aspect_ratio": "1:1",
-            "output_format": "webp",
-            "guidance_scale": 6.09,
-            "output_quality": 90,
-            "prompt_strength": 0.8,
-            "extra_lora_scale": 1,
-            "num_inference_steps": 28
-        }
-    )
-    print(output)
-    # Save the generated image
-    Image.open(requests.get(output[0], stream=True).raw).save(f"{folder}/{id}.png")
-    return True
-
 # Main route handler
 @app.get("/")
 def page_home(session):
@@ -327,8 +448,7 @@ def page_logout(session):
 def page_login(session ):
     is_logged_in = is_user_logged_in(session)
     # Returns the login page with a form to enter email
-    return Div(
-       navigation_bar(session),
+    return navigation_bar(session), Main(
        Div(
            H1("Sign In", cls="text-3xl font-bold tracking-tight uk-margin text-center"),
            P("Enter your email to sign in to The App.", cls="uk-text-muted uk-text-small text-center"),
@@ -342,8 +462,7 @@ def page_login(session ):
 @app.get("/about")
 def page_about(session):
     # Returns the about page with navigation, content, and footer
-    return Title('Easy Life Tours: Discover Romes Ancient Wonders', cls='blue'), Main(
-        navigation_bar(session),
+    return Title('Easy Life Tours: Discover Romes Ancient Wonders', cls='blue'), navigation_bar(session), Main(
         Div(
             # About page content
             Div(
@@ -356,30 +475,18 @@ def page_about(session):
             style="background-image: linear-gradient(to bottom, rgba(0, 0, 0, 0.3), rgba(0, 0, 0, 0.7)), url('media/background_about.webp'); height: 100vh; width: 100vw;"
 
         ),
-        cls='w-full'
-    ), hover_style, Footer(
-        Div(
-            P("© 2023 Easy Life Tours. All rights reserved."),
-            cls='footer-content'
+        hover_style,
+        Footer(
+            Div(
+                P("© 2023 Easy Life Tours. All rights reserved."),
+                cls='footer-content'
+            ),
+            cls='footer bg-black bg-opacity-50 text-white'
         ),
-        cls='footer bg-black bg-opacity-50 text-white'
-    )   
+        cls='w-full'
+    )
 
 
-# Route to get updated balance
-@app.get("/get_updated_balance")
-def get_updated_balance(session):
-    if not is_user_logged_in(session):
-        return "Not logged in"
-    
-    user_email = session['auth']
-    try:
-        user = users[user_email]
-        return f"Balance: {user.balance} credits"
-    except NotFoundError:
-        return "User not found"
-    
-    
 # Route to handle magic link sending
 @app.post("/send_magic_link")
 def page_send_magic_link(email: str):
@@ -442,8 +549,7 @@ def page_generate_images(session):
 
     # checks if user has enough credits
     if user.balance < 1:
-        return Title('Insufficient Credits'), Main(
-            navigation_bar(session),
+        return Title('Insufficient Credits'), navigation_bar(session), Main(
             Div(
                 Div(
                     H1("Insufficient Credits", cls="text-4xl font-bold mb-4 text-white"),
@@ -474,10 +580,20 @@ def page_generate_images(session):
                 name="tour_type",
                 cls='select select-bordered w-full max-w-xs mb-4 bg-white bg-opacity-80',
             ),
+            Label("Number of Images:", for_="num_images", cls="block mb-2 text-white"),
+            Select(
+                *[Option(f"{n} Image{'s' if n > 1 else ''} - {n} Credit{'s' if n > 1 else ''}", value=str(n))
+                  for n in range(1, min(MAX_OUTPUTS, user.balance) + 1)],
+                id="num_images",
+                name="num_images",
+                cls='select select-bordered w-full max-w-xs mb-4 bg-white bg-opacity-80',
+            ),
             Button("Generate Image", cls="btn btn-primary w-full"),
+            idem_key_input('gen-idem-key'),
             cls='w-full max-w-sm bg-black bg-opacity-50 p-6 rounded-lg'
         ),
         hx_post="/generate_images",
+        hx_sync="this:drop",
         target_id='gen-list',
         hx_swap="afterbegin",
         cls='form-control'
@@ -488,8 +604,7 @@ def page_generate_images(session):
     gen_list = Div(*gen_containers[::-1], id='gen-list', cls="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4 mt-8") 
 
     # returns the page with the form and the list of image previews
-    return Title('Generate Roman Images'), Main(
-        navigation_bar(session),
+    return Title('Generate Roman Images'), navigation_bar(session), Main(
         Div(
             Div(
                 H1("Generate Roman Images", cls="text-4xl font-bold mb-4 text-white"),
@@ -501,96 +616,121 @@ def page_generate_images(session):
             ),
             cls="flex flex-col items-center justify-start min-h-screen bg-cover bg-center p-8",
             style="background-image: linear-gradient(rgba(0, 0, 0, 0.6), rgba(0, 0, 0, 0.6)), url('media/generate_images_roman_collesseum.webp');"
-        )
-    ), hover_style
+        ),
+        hover_style
+    )
 
 # A pending preview keeps polling this route until we return the image preview
 @app.get("/gens/{id}")
 def page_preview(id:int, session):
     try:
         gen = gens.get(id)
+        # A failed generation was refunded, so also send the new balance to the navigation bar
+        if gen.status == 'failed' and is_user_logged_in(session):
+            return generation_preview(gen, session), balance_span(users[session['auth']].balance, oob=True)
         return generation_preview(gen, session)
     except NotFoundError:
         return "Generation not found."
 
-# Serve static files (images, CSS, etc.)
-@app.get("/{fname:path}.{ext:static}")
-def page_static(fname:str, ext:str): return FileResponse(f'{fname}.{ext}')
-
-
-
-@app.get("/generate_images")
-def page_generate_images(session):
-    if not is_user_logged_in(session):
-        return login_redir
-
-    user_email = session['auth']
-    try:
-        user = users[user_email]
-    except NotFoundError:
-        return "User not found"
+# Search results per page
+SEARCH_PAGE_SIZE = 12
 
-    if user.balance < 1:
-        return Title('Insufficient Credits'), Main(
-            navigation_bar(session),
-            Div(
-                Div(
-                    H1("Insufficient Credits", cls="text-4xl font-bold mb-4 text-white"),
-                    P("Oops! It looks like your coin purse is empty.", cls="mb-6 text-lg text-white"),
-                    P("Purchase more credits to continue your Roman adventure!", cls="mb-6 text-lg text-white"),
-                    A("Buy Credits", href="/buy_credits", cls="btn btn-primary"),
-                    cls="text-center z-10 relative"
-                ),
-                cls="flex flex-col items-center justify-center min-h-screen bg-cover bg-center",
-                style="background-image: linear-gradient(rgba(0, 0, 0, 0.6), rgba(0, 0, 0, 0.6)), url('media/generate_images_empty_coin_purses.webp');"
-            ),
-            Script("""
-                setTimeout(() => {
-                    window.location.href = '/buy_credits';
-                }, 5000);
-            """)
-        )
+# Render a search snippet, turning the match markers from search_gens into <mark> tags
+def highlight(snippet):
+    return NotStr(html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>'))
 
-    # Create form for generating images
-    add = Form(
+# A search result card with the image (if it was generated) and the highlighted prompt
+def search_result(r):
+    image_path = gen_image_path(r['folder'], r['id'], r['cold'])
+    return Div(
         Div(
-            Label("Select Tour Type:", for_="tour_type", cls="block mb-2 text-white"),
-            Select(
-                Option("Emperors", value="emperors"),
-                Option("Gladiators", value="gladiators"),
-                Option("Citizens", value="citizens"),
-                id="tour_type",
-                name="tour_type",
-                cls='select select-bordered w-full max-w-xs mb-4 bg-white bg-opacity-80',
+            A(
+                Img(src=image_path, alt="Card image", cls="rounded-lg w-full h-auto", loading="lazy"),
+                href=image_path,
+                target="_blank",
+                cls="block"
+            ) if r['status'] != 'failed' and os.path.exists(image_path) else None,
+            Div(
+                P(B(f"{(r['tour_type'] or 'Tour').title()}: "), highlight(r['snippet']), cls="text-sm"),
+                cls="p-4"
             ),
-            Button("Generate Image", cls="btn btn-primary w-full"),
-            cls='w-full max-w-sm bg-black bg-opacity-50 p-6 rounded-lg'
+            cls="card shadow-lg compact bg-base-100"
         ),
-        hx_post="/generate_images",
-        target_id='gen-list',
-        hx_swap="afterbegin",
-        cls='form-control'
+        cls="w-full p-4"
     )
 
-    # Generate list of image previews
-    gen_containers = [generation_preview(g, session) for g in gens(limit=10, where=f"session_id == '{session['session_id']}'")]
-    gen_list = Div(*gen_containers[::-1], id='gen-list', cls="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4 mt-8") 
+# Search page route: full-text search over the user's generation history
+@app.get("/search")
+def page_search(session):
+    if not is_user_logged_in(session):
+        return login_redir
 
-    return Title('Generate Roman Images'), Main(
-        navigation_bar(session),
+    return Title('Search Your Roman Images'), navigation_bar(session), Main(
         Div(
             Div(
-                H1("Generate Roman Images", cls="text-4xl font-bold mb-4 text-white"),
-                P("Create stunning images of ancient Rome with AI!", cls="mb-6 text-lg text-white"),
-                add,
-                Div(id="generation-status", cls="mt-4 text-white"),
-                gen_list,
+                H1("Search Your Roman Images", cls="text-4xl font-bold mb-4 text-white"),
+                Input(type="search", name="q", placeholder="Search prompts, e.g. gladiators colosseum",
+                      cls="input input-bordered w-full max-w-md mb-4 bg-white bg-opacity-80",
+                      hx_get="/search/results",
+                      hx_trigger="input changed delay:300ms, search",
+                      hx_target="#search-results"),
+                Div(id="search-results", cls="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4 mt-8"),
                 cls="text-center w-full max-w-6xl"
             ),
             cls="flex flex-col items-center justify-start min-h-screen bg-cover bg-center p-8",
             style="background-image: linear-gradient(rgba(0, 0, 0, 0.6), rgba(0, 0, 0, 0.6)), url('media/generate_images_roman_collesseum.webp');"
         )
-    ), hover_style
+    )
+
+# One page of ranked search results; the "More results" button swaps itself for the next page
+@app.get("/search/results")
+def page_search_results(session, q: str = "", page: int = 0):
+    if not is_user_logged_in(session):
+        return "User not authenticated"
+
+    page = max(page, 0)
+    # Fetch one extra row to know whether there is another page
+    rows = search_gens(q, [session['auth'], session.get('session_id')], SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    if not rows and page == 0:
+        return P("No matching images." if q.strip() else "", cls="text-white col-span-full")
+
+    more = Div(
+        Button("More results", cls="btn btn-primary",
+               hx_get=f"/search/results?q={quote(q)}&page={page + 1}",
+               hx_target="closest div",
+               hx_swap="outerHTML"),
+        cls="col-span-full"
+    ) if len(rows) > SEARCH_PAGE_SIZE else None
+    return *[search_result(r) for r in rows[:SEARCH_PAGE_SIZE]], more
+
+# Per-host metrics for this process's outbound HTTP calls (admins only)
+@app.get("/admin/http_metrics")
+def page_http_metrics(session):
+    if not is_admin(session): return Response(status_code=404)
+    return JSONResponse(transport.snapshot())
+
+# Serve a hashed bundle, precompressed where the browser accepts it; its name changes with its content
+def bundle_response(folder, fname, req, media_type):
+    path = f"{folder}/{os.path.basename(fname)}"
+    if not os.path.exists(path): return Response(status_code=404)
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'Vary': 'Accept-Encoding'}
+    accept = req.headers.get('accept-encoding', '')
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accept and os.path.exists(path + suffix):
+            headers['Content-Encoding'] = encoding
+            return FileResponse(path + suffix, media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@app.get("/static/css/{fname}")
+def page_css_bundle(fname:str, req): return bundle_response(CSS_DIR, fname, req, 'text/css')
+
+@app.get("/static/js/{fname}")
+def page_js_bundle(fname:str, req): return bundle_response(JS_DIR, fname, req, 'text/javascript')
+
+# Serve static files (images, CSS, etc.)
+@app.get("/{fname:path}.{ext:static}")
+def page_static(fname:str, ext:str): return FileResponse(f'{fname}.{ext}')
+
 
 
 # Stripe route to buy credits
@@ -598,8 +738,7 @@ def page_generate_images(session):
 def page_buy_credits(session):
     print("page_buy_credits GET called")  # Debug statement
 
-    return Title('Buy Credits'), Main(
-        navigation_bar(session),
+    return Title('Buy Credits'), navigation_bar(session), Main(
         Div(
             Div(
                 H1("Purchase Credits", cls="text-4xl font-bold mb-4 text-white"),
@@ -619,7 +758,9 @@ def page_buy_credits(session):
                     Button("Buy Credits", type="submit", cls="btn btn-primary w-full", 
                            hx_post="/buy_credits",
                            hx_target="#payment-status",
-                           hx_swap="innerHTML"),
+                           hx_swap="innerHTML",
+                           hx_sync="closest form:drop"),
+                    idem_key_input('buy-idem-key'),
                     cls="w-full max-w-sm bg-black bg-opacity-50 p-6 rounded-lg"
                 ),
                 Div(id="payment-status", cls="mt-4 text-white"),
@@ -632,21 +773,26 @@ def page_buy_credits(session):
     
     
 @app.post("/buy_credits")
-def page_buy_credits_post(credit_amount: int, session):
+def page_buy_credits_post(credit_amount: int, session, idem_key: str = ""):
     print("page_buy_credits POST called")  # Debug statement
 
     if not is_user_logged_in(session):
         print("User not logged in")  # Debug statement
         return login_redir
 
-    user_email = session['auth']
+    # A repeated submission replays the first one's response instead of creating another checkout session
+    key = f"{session['auth']}:buy_credits:{idem_key}" if idem_key else None
+    return idempotent(key, lambda: create_checkout(credit_amount, session['auth'], key)), idem_key_input('buy-idem-key', oob=True)
+
+# Create a Stripe Checkout session for the credits and redirect the browser to it
+def create_checkout(credit_amount, user_email, key):
     print(f"Processing purchase for user: {user_email}")  # Debug statement
 
     try:
         user = users[user_email]
     except NotFoundError:
         print(f"User {user_email} not found in database")  # Debug statement
-        return "User not found."
+        raise RetryableResponse("User not found.")
 
     # Validate credit_amount
     if credit_amount < 1 or credit_amount > 5:
@@ -673,11 +819,13 @@ def page_buy_credits_post(credit_amount: int, session):
             metadata={
                 'user_email': user_email,
                 'credit_amount': credit_amount  # Pass the selected credit amount
-            }
+            },
+            # Stripe also collapses repeats of the same request on its side
+            idempotency_key=key
         )
     except Exception as e:
         print(f"Stripe Checkout Session creation error: {str(e)}")  # Debug statement
-        return Div(f"Error creating Stripe session: {str(e)}", cls="text-red-500")
+        raise RetryableResponse(Div(f"Error creating Stripe session: {str(e)}", cls="text-red-500"))
 
     # Return a redirect response that HTMX can handle
     print("Stripe Checkout Session created successfully")  # Debug statement
@@ -689,30 +837,25 @@ def page_buy_credits_post(credit_amount: int, session):
 
 # Generation route
 @app.post("/generate_images")
-def page_generate_images(tour_type: str, session):
+def page_generate_images(tour_type: str, session, num_images: int = 1, idem_key: str = ""):
     if 'auth' not in session: 
         return "User not authenticated"
 
+    # A repeated submission (double click, htmx retry) replays the first one's response instead of debiting again
+    key = f"{session['auth']}:generate_images:{idem_key}" if idem_key else None
+    return idempotent(key, lambda: start_generation(tour_type, session, num_images)), idem_key_input('gen-idem-key', oob=True)
+
+# Debit the credits, record the generations and queue them for the workers
+def start_generation(tour_type, session, num_images):
     user_email = session['auth']
     try:
         user = users[user_email]
     except NotFoundError:
-        return "User not found"
+        raise RetryableResponse("User not found")
     
-    if user.balance < 1:
-        return Div(
-            P("Insufficient balance! Please purchase more credits."),
-            Script("""
-                setTimeout(() => {
-                    window.location.href = '/buy_credits';
-                }, 5000);
-            """)
-        )
-    else:
-        # Deduct 1 credit from the user's balance
-        new_balance = user.balance - 1
-        users.update({'email': user_email, 'balance': new_balance})
-        print(f"Debug: New balance for {user_email} is {new_balance}")
+    # Validate num_images
+    if num_images < 1 or num_images > MAX_OUTPUTS:
+        return Div(f"You can generate between 1 and {MAX_OUTPUTS} images at a time.", cls="text-red-500")
 
     # Predefined prompts for different tour types
     prompts = {
@@ -730,19 +873,31 @@ def page_generate_images(tour_type: str, session):
     # Add a specific detail to the prompt
     prompt = prompt + " Some of the people, statues, or objects in the scene should look like TOK"
 
-    # Generate and save the image
+    # Deduct one credit per requested image, record one row per image sharing the batch folder and hand
+    # the batch to the generation workers (see worker.py), all in one transaction. The debit only applies
+    # if the balance covers it, so concurrent submissions (e.g. from two tabs) can't take it below zero.
     folder = f"data/gens/{str(uuid.uuid4())}"
     os.makedirs(folder, exist_ok=True)
-    g = gens.insert(
-        Generation(prompt=prompt,
-                   folder=folder,
-                   session_id=session['session_id'])
-    )
-    generate_and_save(g.prompt, g.id, g.folder)
+    created = create_generations(user_email, session['session_id'], prompt, folder,
+                                 tour_type if tour_type in TOUR_TYPES else None, num_images)
+    # Not stored for replay: the same submission can succeed once credits have been bought
+    if created is None:
+        raise RetryableResponse(Div(
+            P("Insufficient balance! Please purchase more credits."),
+            Script("""
+                setTimeout(() => {
+                    window.location.href = '/buy_credits';
+                }, 5000);
+            """)
+        ))
+    new_balance, rows = created
+    batch = [Generation(**r) for r in rows]
+    print(f"Debug: New balance for {user_email} is {new_balance}")
 
-    return Div(
-        generation_preview(g, session),
-        Script("htmx.trigger(document.body, 'balanceUpdated');")
+    # One card per image, added straight into the gallery grid, plus the new balance for the navigation bar
+    return (
+        *[generation_preview(g, session) for g in batch],
+        balance_span(new_balance, oob=True)
     )
 
 # Stripe route for payment cancellation
@@ -773,7 +928,7 @@ def page_cancel():
 # Stripe route for successful payment
 @app.get("/success")
 def page_success(session):
-    return Titled("Payment Successful", 
+    return navigation_bar(session), Titled("Payment Successful", 
         Div(
             cls="content",
             style="background-image: url('media/success.webp'); background-size: cover; height: 100vh; color: white; position: relative;",
@@ -790,8 +945,6 @@ def page_success(session):
         ),
         Script("""
             setTimeout(() => {
-                // Trigger HTMX to fetch the updated balance
-                htmx.trigger(document.body, 'balanceUpdated');
                 window.location.href = '/';
             }, 5000);
         """)
@@ -817,11 +970,10 @@ async def page_stripe_webhook(request):
         if not user_email or not credit_amount:
             return {'error': 'Missing user email or credit amount in metadata'}, 400
 
-        try:
-            user = users[user_email]
-            new_balance = user.balance + int(credit_amount)  # Add the corresponding credits
-            users.update({'email': user_email, 'balance': new_balance})
-        except NotFoundError:
+        # Add the corresponding credits and record the payment in the ledger
+        new_balance = adjust_balance(user_email, int(credit_amount), 'purchase',
+                                     ref=session_obj['id'], amount_cents=session_obj.get('amount_total') or 0)
+        if new_balance is None:
             print(f"User with email {user_email} not found.")
             return {'error': 'User not found'}, 404
 
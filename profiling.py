@@ -0,0 +1,130 @@
+"""
+On-demand request profiling for SafeFast virtual tours.
+
+ProfilingMiddleware samples the stacks of a request while it runs and writes them
+in the collapsed ("folded") format that flamegraph.pl, speedscope and inferno read,
+to profiles/<route>/<time>-<duration>ms.folded. A request is profiled when:
+
+- it carries an unexpired signature for its path, in an `X-Profile` header or a
+  `__profile` query parameter (requires PROFILE_SECRET; print one, valid for
+  PROFILE_LINK_TTL seconds, with `python -m profiling sign /gens/12`), or
+- it is picked by random 1-in-PROFILE_SAMPLE_RATE sampling (0, the default, turns this off).
+
+Requests that are not profiled only pay for the header check, so the middleware
+can stay deployed. The sampler reads every thread's stack (sync routes run in a
+thread pool) and keeps the stacks that are running our own code. If several
+requests run at once, their samples can end up in each other's profiles.
+"""
+
+from collections import Counter
+from urllib.parse import parse_qs
+import hashlib, hmac, os, random, re, sys, threading, time
+from starlette.routing import Match
+
+PROFILE_SECRET = os.getenv('PROFILE_SECRET', '')
+SAMPLE_RATE = int(os.getenv('PROFILE_SAMPLE_RATE', 0))
+INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# How long a signature printed by `python -m profiling sign` stays valid, in seconds
+LINK_TTL = int(os.getenv('PROFILE_LINK_TTL', 900))
+# Profiles kept per route; older ones are deleted
+KEEP = int(os.getenv('PROFILE_KEEP', 50))
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+# Signature, as `<expiry>.<mac>`, that turns on profiling for requests to `path` until the unix time `expires`
+def sign(path, expires):
+    mac = hmac.new(PROFILE_SECRET.encode(), f"{path}\n{expires}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{mac}"
+
+# Whether the request carries a valid, unexpired signature. Header and query values are client input,
+# so they are compared as bytes and anything malformed just means "no".
+def is_requested(scope):
+    if not PROFILE_SECRET: return False
+    sig = dict(scope['headers']).get(b'x-profile', b'')
+    if not sig: sig = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('__profile', [''])[0].encode('latin-1', 'ignore')
+    expires, _, _ = sig.partition(b'.')
+    if not expires.isdigit() or int(expires) < time.time(): return False
+    return hmac.compare_digest(sig, sign(scope['path'], int(expires)).encode())
+
+# Label a frame by function and file, so all samples in one function merge into one flamegraph box
+def frame_label(code):
+    parts = code.co_filename.replace('\\', '/').split('/')
+    return f"{code.co_name} ({'/'.join(parts[-2:])}:{code.co_firstlineno})"
+
+class Sampler(threading.Thread):
+    "Counts the stacks of threads running project code every `interval` seconds until stopped"
+    def __init__(self, interval):
+        super().__init__(daemon=True, name='profiler')
+        self.interval, self.stacks, self.samples = interval, Counter(), 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.samples += 1
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me: continue
+                stack, ours = [], False
+                while frame is not None:
+                    code = frame.f_code
+                    if (code.co_filename.startswith(PROJECT_DIR) and code.co_filename != __file__
+                        and code.co_name != '<module>'): ours = True
+                    stack.append(frame_label(code))
+                    frame = frame.f_back
+                if ours: self.stacks[';'.join([names.get(tid, str(tid)), *reversed(stack)])] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+# Write the samples as a folded-stacks file under the route's directory
+def write_profile(route, sampler, seconds):
+    slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', route.strip('/')) or 'root'
+    folder = os.path.join(PROFILE_DIR, slug)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{time.strftime('%Y%m%d-%H%M%S')}-{seconds * 1000:.0f}ms.folded")
+    with open(path, 'w') as f:
+        for stack, n in sampler.stacks.most_common(): f.write(f"{stack} {n}\n")
+    for old in sorted(os.listdir(folder))[:-KEEP]: os.remove(os.path.join(folder, old))
+    print(f"Profiled {route} in {seconds * 1000:.0f}ms ({sampler.samples} samples): {path}")
+
+# The template of the route that handles the request (e.g. /gens/{id}), so each route's profiles share one
+# directory however many distinct paths it serves; requests no route matches share 'other'
+def route_template(scope):
+    partial = None
+    for route in getattr(scope.get('app'), 'routes', []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL: return route.path
+        if match == Match.PARTIAL and partial is None: partial = route.path
+    return partial or 'other'
+
+class ProfilingMiddleware:
+    "ASGI middleware that profiles signed or randomly sampled requests"
+    def __init__(self, app): self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not (is_requested(scope) or (SAMPLE_RATE and random.randrange(SAMPLE_RATE) == 0)):
+            return await self.app(scope, receive, send)
+        sampler = Sampler(INTERVAL)
+        sampler.start()
+        start = time.perf_counter()
+        try: await self.app(scope, receive, send)
+        finally:
+            seconds = time.perf_counter() - start
+            sampler.stop()
+            route = route_template(scope)
+            try: write_profile(route, sampler, seconds)
+            except OSError as e: print(f"Could not write profile for {route}: {e!r}")
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] != ['sign'] or len(args) not in (2, 3) or not all(a.isdigit() for a in args[2:]):
+        sys.exit("usage: python -m profiling sign <path> [ttl seconds]")
+    if not PROFILE_SECRET: sys.exit("PROFILE_SECRET is not set")
+    path, ttl = args[1], int(args[2]) if len(args) == 3 else LINK_TTL
+    sig = sign(path, int(time.time()) + ttl)
+    print(f"X-Profile: {sig}")
+    print(f"or {path}?__profile={sig}")
+    print(f"valid for {ttl}s")
@@ -0,0 +1,187 @@
+"""
+Retention and garbage collection for generated images and data/gens.db.
+
+Policies, all configurable from the environment (0 turns a policy off):
+
+- RETENTION_USER_QUOTA: keep at most this many generations per user, deleting the oldest
+- RETENTION_ANON_DAYS: delete generations marked anonymous (made without an account) after this many
+  days; off by default. Rows without an email from before accounts were recorded are not anonymous.
+- RETENTION_COLD_DAYS: re-encode images older than this many days as WebP ("cold" storage)
+- RETENTION_FAILED_DAYS: delete failed generations (already refunded) after this many days
+- RETENTION_JOB_DAYS: delete finished jobs from the queue after this many days
+- RETENTION_IDEMPOTENCY_DAYS: delete stored responses to idempotent submissions after this many days
+
+Garbage collection then removes folders under data/gens that no gens row refers to,
+such as folders left behind by failed or crashed generations, and finally runs
+`PRAGMA incremental_vacuum` so the database file gives freed pages back. That needs
+the database in incremental auto_vacuum mode, which takes a one-off full VACUUM
+holding the write lock for as long as it runs; do it by hand, ideally during a
+quiet period, with `python -m retention --convert`.
+
+Everything works in batches of RETENTION_BATCH rows or folders, so a run needs the
+same memory however large the data grows. The generation worker runs it every
+RETENTION_INTERVAL seconds (only one worker per interval); run it by hand with
+`python -m retention`.
+"""
+
+import os, shutil, sys, time
+from PIL import Image
+from db import db, claim_maintenance
+
+GENS_DIR = 'data/gens'
+
+USER_QUOTA = int(os.getenv('RETENTION_USER_QUOTA', 0))
+ANON_DAYS = float(os.getenv('RETENTION_ANON_DAYS', 0))
+COLD_DAYS = float(os.getenv('RETENTION_COLD_DAYS', 14))
+FAILED_DAYS = float(os.getenv('RETENTION_FAILED_DAYS', 1))
+JOB_DAYS = float(os.getenv('RETENTION_JOB_DAYS', 7))
+IDEMPOTENCY_DAYS = float(os.getenv('RETENTION_IDEMPOTENCY_DAYS', 1))
+# Folders are created before their rows are inserted, so only collect unreferenced ones older than this
+ORPHAN_GRACE = float(os.getenv('RETENTION_ORPHAN_GRACE', 3600))
+BATCH = int(os.getenv('RETENTION_BATCH', 500))
+INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))
+# Pages freed per incremental_vacuum step
+VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 2000))
+
+def days_ago(days): return time.time() - days * 86400
+
+# Delete gens rows together with their image files
+def delete_gens(rows):
+    for r in rows:
+        for ext in ('png', 'webp'):
+            try: os.remove(f"{r['folder']}/{r['id']}.{ext}")
+            except FileNotFoundError: pass
+    ids = [r['id'] for r in rows]
+    db.execute(f"DELETE FROM gens WHERE id IN ({','.join('?' * len(ids))})", ids)
+    return len(ids)
+
+# Delete the rows returned by `sql` (which must select id and folder and end in LIMIT ?) batch by batch
+def delete_matching(sql, params):
+    n = 0
+    while rows := db.q(sql, [*params, BATCH]):
+        n += delete_gens(rows)
+    return n
+
+# Delete each user's oldest finished generations beyond the quota
+def enforce_user_quota():
+    if not USER_QUOTA: return 0
+    n, last = 0, ''
+    # Walk the users over quota in email order, a batch at a time
+    while over := db.q("""SELECT email FROM gens WHERE email > ? GROUP BY email HAVING COUNT(*) > ?
+                          ORDER BY email LIMIT ?""", [last, USER_QUOTA, BATCH]):
+        for r in over:
+            n += delete_matching("""SELECT id, folder FROM gens WHERE email = ? AND status IS NOT 'pending' AND id < (
+                                        SELECT id FROM gens WHERE email = ? ORDER BY id DESC LIMIT 1 OFFSET ?)
+                                    ORDER BY id LIMIT ?""", [r['email'], r['email'], USER_QUOTA - 1])
+        last = over[-1]['email']
+    return n
+
+# Delete generations made without an account once they are old enough
+def expire_anonymous():
+    if not ANON_DAYS: return 0
+    return delete_matching("SELECT id, folder FROM gens WHERE anonymous = 1 AND status IS NOT 'pending' AND created_at < ? LIMIT ?",
+                           [days_ago(ANON_DAYS)])
+
+# Delete failed generations; their credits were refunded when they failed
+def expire_failed():
+    if not FAILED_DAYS: return 0
+    return delete_matching("SELECT id, folder FROM gens WHERE status = 'failed' AND created_at < ? LIMIT ?",
+                           [days_ago(FAILED_DAYS)])
+
+# Re-encode old PNGs as WebP, which is several times smaller. Rows from before status was tracked
+# count as done; those whose image was never saved are skipped by the file check.
+def compress_cold():
+    if not COLD_DAYS: return 0
+    n, last = 0, 0
+    while rows := db.q("""SELECT id, folder FROM gens WHERE id > ? AND COALESCE(status, 'done') = 'done' AND NOT COALESCE(cold, 0)
+                          AND created_at < ? ORDER BY id LIMIT ?""", [last, days_ago(COLD_DAYS), BATCH]):
+        for r in rows:
+            png, webp = f"{r['folder']}/{r['id']}.png", f"{r['folder']}/{r['id']}.webp"
+            if not os.path.exists(png): continue
+            with Image.open(png) as im: im.save(webp, 'WEBP', quality=85, method=6)
+            db.execute("UPDATE gens SET cold = 1 WHERE id = ?", [r['id']])
+            os.remove(png)
+            n += 1
+        last = rows[-1]['id']
+    return n
+
+# Delete rows matching `where` from `table` batch by batch, returning how many were deleted
+def delete_rows(table, where, params):
+    n = 0
+    while deleted := len(db.q(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?) RETURNING 1",
+                              [*params, BATCH])):
+        n += deleted
+    return n
+
+# Delete finished jobs; their gens rows keep the outcome
+def prune_jobs():
+    if not JOB_DAYS: return 0
+    return delete_rows('jobs', "status IN ('done', 'failed') AND created_at < ?", [days_ago(JOB_DAYS)])
+
+# Delete stored idempotent responses, long after a repeat of their submission could arrive
+def prune_idempotency():
+    if not IDEMPOTENCY_DAYS: return 0
+    return delete_rows('idempotency', "created_at < ?", [days_ago(IDEMPOTENCY_DAYS)])
+
+# Remove folders under data/gens that no gens row refers to
+def collect_orphans():
+    if not os.path.isdir(GENS_DIR): return 0
+    n, cutoff = 0, time.time() - ORPHAN_GRACE
+    def sweep(batch):
+        folders = [f"{GENS_DIR}/{e.name}" for e in batch]
+        used = {r['folder'] for r in db.q(f"SELECT DISTINCT folder FROM gens WHERE folder IN ({','.join('?' * len(folders))})", folders)}
+        removed = 0
+        for e, folder in zip(batch, folders):
+            if folder not in used and e.stat().st_mtime < cutoff:
+                shutil.rmtree(e.path, ignore_errors=True)
+                removed += 1
+        return removed
+    batch = []
+    with os.scandir(GENS_DIR) as it:
+        for e in it:
+            if not e.is_dir(): continue
+            batch.append(e)
+            if len(batch) == BATCH:
+                n += sweep(batch)
+                batch = []
+    if batch: n += sweep(batch)
+    return n
+
+# Switch the database to incremental auto_vacuum. This takes a full VACUUM, which rewrites the whole file
+# while holding the write lock, so it is only ever run by hand (`python -m retention --convert`)
+def convert():
+    if db.q("PRAGMA auto_vacuum")[0]['auto_vacuum'] == 2: return print("data/gens.db already uses incremental auto_vacuum")
+    print("Switching data/gens.db to incremental auto_vacuum (full VACUUM, writers wait until it finishes)")
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("VACUUM")
+
+# Give freed pages back to the filesystem
+def vacuum():
+    # Free pages in steps so other writers can get in between; db.q steps the pragma to completion
+    free = db.q("PRAGMA freelist_count")[0]['freelist_count']
+    if free and db.q("PRAGMA auto_vacuum")[0]['auto_vacuum'] != 2:
+        print(f"{free} free pages in data/gens.db; run `python -m retention --convert` once so they can be reclaimed")
+        free = 0
+    while free:
+        db.q(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        left = db.q("PRAGMA freelist_count")[0]['freelist_count']
+        if left >= free: break
+        free = left
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+# Apply every policy, then collect garbage and vacuum
+def run():
+    start = time.time()
+    results = dict(quota=enforce_user_quota(), anonymous=expire_anonymous(), failed=expire_failed(),
+                   cold=compress_cold(), jobs=prune_jobs(), idempotency=prune_idempotency(), orphans=collect_orphans())
+    vacuum()
+    print(f"Retention run took {time.time() - start:.1f}s: " + ', '.join(f"{k}={v}" for k, v in results.items()))
+    return results
+
+# Run retention if no worker has run it in the last INTERVAL seconds
+def run_if_due():
+    if INTERVAL and claim_maintenance('retention', INTERVAL): run()
+
+if __name__ == '__main__':
+    if '--convert' in sys.argv[1:]: convert()
+    else: run()
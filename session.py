@@ -1,6 +1,7 @@
 from fastcore.parallel import threaded
 from fasthtml.common import *
-import uuid, os, uvicorn, requests, replicate
+import uuid, os, io, uvicorn, replicate
+from http_client import http
 from PIL import Image
 
 # Replicate setup (for generating images)
@@ -78,7 +79,9 @@ def generate_and_save(prompt, id, folder):
             "prompt_strength": 0.8, "num_inference_steps": 25
         }
     )
-    Image.open(requests.get(output[0], stream=True).raw).save(f"{folder}/{id}.png")
+    r = http.get(output[0])
+    r.raise_for_status()
+    Image.open(io.BytesIO(r.content)).save(f"{folder}/{id}.png")
     return True
 
 if __name__ == '__main__': uvicorn.run("main:app", host='0.0.0.0', port=int(os.getenv("PORT", default=5000)))
@@ -0,0 +1,11 @@
+#!/bin/sh
+# Production entry point (railway.toml startCommand): the web app plus WORKER_PROCESSES generation workers.
+# They run in one service because they share data/gens.db and data/gens, which live on the service's
+# volume, and a Railway volume can only be mounted into one service. Each worker is restarted if it exits.
+WORKERS=${WORKER_PROCESSES:-2}
+i=0
+while [ "$i" -lt "$WORKERS" ]; do
+    (while true; do python -m worker; echo "worker exited with status $?, restarting in 5s"; sleep 5; done) &
+    i=$((i + 1))
+done
+exec python main.py
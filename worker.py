@@ -0,0 +1,246 @@
+"""
+Generation worker for SafeFast virtual tours.
+
+The web app only records generations and enqueues a job for them; this process
+claims jobs from the queue in data/gens.db, calls Replicate and saves the images.
+Run as many copies as needed with `python -m worker`. Each claim takes a lease
+that is kept alive by a heartbeat while the job runs, so if a worker crashes its
+job is picked up again by another worker once the lease expires. SIGTERM/SIGINT
+stop the worker after the job it is currently running.
+
+Each stage has a timeout and transient failures of downloads and polls are
+retried with jittered backoff. Since every new prediction is paid for, creating
+one is only retried when the request never reached Replicate (or was rate
+limited), and a prediction that overruns its deadline is cancelled, not retried.
+A circuit breaker stops calling Replicate while it keeps failing, leaving jobs
+on the queue. Images that still cannot be generated are marked
+failed, which stops the page polling for them, and their credits are refunded.
+"""
+
+from fastcore.parallel import parallel
+import io, os, json, random, signal, socket, threading, time, uuid, httpx, replicate
+from PIL import Image
+from http_client import http, transport, format_metrics
+from db import claim_job, heartbeat_job, release_job, finish_job, fail_abandoned_jobs
+import retention
+
+# Worker settings, overridable from the environment
+LEASE_SECONDS = int(os.getenv('WORKER_LEASE_SECONDS', 60))
+POLL_SECONDS = float(os.getenv('WORKER_POLL_SECONDS', 1))
+MAX_ATTEMPTS = int(os.getenv('WORKER_MAX_ATTEMPTS', 3))
+
+# Timeouts for each stage, in seconds
+PREDICTION_TIMEOUT = float(os.getenv('PREDICTION_TIMEOUT', 300))
+API_TIMEOUT = httpx.Timeout(float(os.getenv('API_READ_TIMEOUT', 30)), connect=5)
+DOWNLOAD_TIMEOUT = httpx.Timeout(float(os.getenv('DOWNLOAD_READ_TIMEOUT', 30)), connect=5)
+
+# Retries for transient failures: up to RETRY_ATTEMPTS tries with full-jitter exponential backoff
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 20))
+
+# Circuit breaker: stop calling Replicate for a while after this many consecutive failures
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 60))
+
+MODEL_VERSION = "a8a38acebd2b927ea95ab68a2e20626c81b135196116dbff8db298baf1da1fd0"
+
+# How often an idle worker logs its outbound HTTP metrics
+METRICS_INTERVAL = float(os.getenv('WORKER_METRICS_INTERVAL', 300))
+
+# Set up Replicate client for image generation, using the shared connection pools
+replicate_api_token = os.environ['REPLICATE_API_KEY']
+client = replicate.Client(api_token=replicate_api_token, timeout=API_TIMEOUT, transport=transport)
+
+class CircuitOpen(Exception): pass
+class PredictionFailed(Exception): pass
+class PredictionTimeout(Exception): pass
+
+class CircuitBreaker:
+    "Fails fast after `threshold` consecutive failures, then lets one trial call through every `cooldown` seconds"
+    def __init__(self, threshold, cooldown):
+        self.threshold, self.cooldown = threshold, cooldown
+        self.failures, self.opened_at = 0, None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None: return True
+            if time.monotonic() - self.opened_at < self.cooldown: return False
+            # Half open: re-arm the cooldown so only this call goes through
+            self.opened_at = time.monotonic()
+            return True
+
+    def is_open(self):
+        with self.lock: return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def record(self, ok):
+        with self.lock:
+            if ok: self.failures, self.opened_at = 0, None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold: self.opened_at = time.monotonic()
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+# Set when the worker has been asked to shut down
+stopping = threading.Event()
+
+# HTTP status of a failed API call, if it got a response
+def error_status(e):
+    status = getattr(getattr(e, 'response', None), 'status_code', None) or getattr(e, 'status', None)
+    return status if isinstance(status, int) else None
+
+# Network errors, timeouts, rate limits and server errors are worth retrying; anything else is not
+def is_transient(e):
+    if isinstance(e, (TimeoutError, httpx.TransportError)): return True
+    status = error_status(e)
+    return status is not None and (status == 429 or status >= 500)
+
+# Failures after which the request certainly wasn't acted on: no connection was made, or it was rate limited.
+# Only these are safe to retry for calls that create something we pay for, since a read timeout or a 5xx
+# may come after the server already did the work (Replicate's own client doesn't retry POSTs either).
+def is_unsent(e):
+    return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)) or error_status(e) == 429
+
+# Call fn, retrying failures that `retry_if` accepts with jittered exponential backoff
+def with_retries(fn, *args, retry_if=is_transient, **kwargs):
+    for attempt in range(RETRY_ATTEMPTS):
+        try: return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not retry_if(e) or stopping.is_set(): raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            print(f"{fn.__name__} failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+# Run one prediction on Replicate and return its output URLs, cancelling it if it overruns the deadline.
+# Creating it is only retried when the request certainly wasn't acted on, since each new prediction is paid for.
+def run_prediction(prompt, num_outputs):
+    if not breaker.allow(): raise CircuitOpen()
+    try:
+        prediction = with_retries(client.predictions.create, version=MODEL_VERSION, input=model_input(prompt, num_outputs),
+                                  retry_if=is_unsent)
+        deadline = time.monotonic() + PREDICTION_TIMEOUT
+        while prediction.status not in ('succeeded', 'failed', 'canceled'):
+            if time.monotonic() > deadline:
+                try: prediction.cancel()
+                except Exception as e: print(f"Could not cancel prediction {prediction.id}: {e!r}")
+                raise PredictionTimeout(f"prediction {prediction.id} did not finish in {PREDICTION_TIMEOUT}s")
+            time.sleep(1)
+            # A failed poll is retried by the next pass of the loop
+            try: prediction.reload()
+            except Exception as e:
+                if not is_transient(e): raise
+    except Exception as e:
+        # Overrunning the deadline is terminal for the job but still counts against Replicate's health
+        breaker.record(not (is_transient(e) or isinstance(e, PredictionTimeout)))
+        raise
+    breaker.record(True)
+    if prediction.status != 'succeeded': raise PredictionFailed(f"prediction {prediction.id} {prediction.status}: {prediction.error}")
+    return prediction.output
+
+# Input for the Replicate model
+def model_input(prompt, num_outputs):
+    return {
+        "width": 1024,
+        "height": 1024,
+        "model": "dev",
+        "prompt": prompt,
+        "lora_scale": 1.34,
+        "num_outputs": num_outputs,
+        "aspect_ratio": "1:1",
+        "output_format": "webp",
+        "guidance_scale": 6.09,
+        "output_quality": 90,
+        "prompt_strength": 0.8,
+        "extra_lora_scale": 1,
+        "num_inference_steps": 28
+    }
+
+# Download one output of a prediction and save it under its generation id
+def save_output(url, id, folder):
+    r = http.get(url, timeout=DOWNLOAD_TIMEOUT)
+    r.raise_for_status()
+    Image.open(io.BytesIO(r.content)).save(f"{folder}/{id}.png")
+
+# Download one output with retries; returns its generation id if it was saved
+def download_output(item, folder):
+    url, id = item
+    try:
+        with_retries(save_output, url, id, folder)
+        return id
+    except Exception as e:
+        print(f"Could not save image {id} from {url}: {e!r}")
+
+# Generate a batch of images and save them to the folder; returns the ids that were saved
+def generate_and_save(prompt, ids, folder):
+    # Call the Replicate API once for the whole batch
+    output = run_prediction(prompt, len(ids))
+    print(output)
+    # Download and save the generated images in parallel
+    saved = parallel(download_output, list(zip(output, ids)), folder=folder, n_workers=len(ids), threadpool=True, progress=False)
+    return [id for id in saved if id is not None]
+
+# Keep extending the lease on a job until `done` is set
+def keep_lease(job_id, owner, done):
+    while not done.wait(LEASE_SECONDS / 3):
+        if not heartbeat_job(job_id, owner, LEASE_SECONDS):
+            print(f"Lost lease on job {job_id}")
+            return
+
+# Run one claimed job while heartbeating its lease
+def run_job(job, owner):
+    finished = threading.Event()
+    heartbeat = threading.Thread(target=keep_lease, args=(job.id, owner, finished), daemon=True)
+    heartbeat.start()
+    ids = json.loads(job.gen_ids)
+    try:
+        done = generate_and_save(job.prompt, ids, job.folder)
+    except CircuitOpen:
+        print(f"Replicate circuit is open, returning job {job.id} to the queue")
+        release_job(job.id, owner)
+        return
+    except Exception as e:
+        print(f"Job {job.id} failed: {e!r}")
+        done = []
+    finally:
+        finished.set()
+        heartbeat.join()
+    failed = [id for id in ids if id not in done]
+    if failed: print(f"Job {job.id}: refunding {len(failed)} credit(s) for images that failed")
+    if not finish_job(job.id, owner, done, failed): print(f"Lost lease on job {job.id} before finishing it")
+
+def handle_signal(signum, frame):
+    print(f"Received signal {signum}, finishing current job before exiting")
+    stopping.set()
+
+# Claim and run jobs until asked to stop
+def main():
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    print(f"Worker {owner} started")
+    metrics_logged = time.monotonic()
+    while not stopping.is_set():
+        # Wait while Replicate is failing rather than claiming jobs we can't run
+        if breaker.is_open():
+            stopping.wait(POLL_SECONDS)
+            continue
+        job = claim_job(owner, LEASE_SECONDS, MAX_ATTEMPTS)
+        if job is None:
+            if n := fail_abandoned_jobs(MAX_ATTEMPTS): print(f"Failed and refunded {n} abandoned job(s)")
+            # Idle time is when periodic retention and garbage collection run
+            try: retention.run_if_due()
+            except Exception as e: print(f"Retention run failed: {e!r}")
+            if time.monotonic() - metrics_logged > METRICS_INTERVAL:
+                if metrics := format_metrics(): print(f"Outbound HTTP:\n{metrics}")
+                metrics_logged = time.monotonic()
+            stopping.wait(POLL_SECONDS)
+            continue
+        print(f"Worker {owner} claimed job {job.id} (attempt {job.attempts})")
+        run_job(job, owner)
+    print(f"Worker {owner} stopped")
+    if metrics := format_metrics(): print(f"Outbound HTTP:\n{metrics}")
+    http.close()
+
+if __name__ == '__main__': main()